@@ -0,0 +1,2 @@
+# the modules under test live at the repo root, pytest puts this directory on sys.path
+# for any conftest.py it finds here, so tests import them with plain pytest too
@@ -1,106 +1,281 @@
+import contextlib
+import functools
 import os
 import re
+import shutil
+import signal
 import subprocess
 import sys
-from collections import OrderedDict
-from multiprocessing import Pool
-
-def break_up_pipes(commands):
-    cs = []
-    temp = []
-    for c in commands:
-        if c == '|':
-            cs.append(temp)
-            temp = []
-        else:
-            temp.append(c)
-    cs.append(temp)
-    return cs
-
-def run_subprocesses(commands):
-    cs = break_up_pipes(commands)
-    
-    # if just one command then just run
-    if len(cs) == 1:
-        return subprocess.check_output(cs[0])
-    
-    open_processes = []
-    prev = None
-    c = 0
-    for i, commands in enumerate(cs):
-        if i == 0:
-            prev = subprocess.Popen(commands, stdout=subprocess.PIPE)
-            open_processes.append(prev)
-        elif len(cs) - 1 != c:
-            prev = subprocess.Popen(commands, stdin=prev.stdout, stdout=subprocess.PIPE)
-            open_processes.append(prev)
-        else:
-            result = subprocess.check_output(commands, stdin=prev.stdout)
-
-        c += 1
-
-    for ps in open_processes:
-        ps.wait()
-        
-    return result
+from multiprocessing import get_context
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+_BAM_SUFFIX_RE = re.compile(r'\.bam$')
+
+# commands are built as bytes so subprocess can hand them to exec without encoding each call.
+# on python 3.8+ the full samtools path lets subprocess start commands run with close_fds=False,
+# the pipeline stages and the index fallback, with posix_spawn instead of fork and exec, which
+# doesn't have to copy the page tables of a large parent process. the version probe keeps
+# the default close_fds and still forks, once per run
+_SAMTOOLS = os.fsencode(shutil.which('samtools') or 'samtools')
+
+# buffer size requested for pipes between commands, the kernel default is 64KiB
+PIPE_SIZE = 1 << 20
+
+# first samtools version with the view -M multi-region iterator
+MULTI_REGION_VERSION = (1, 7)
+
+@functools.lru_cache(maxsize=1)
+def get_samtools_version():
+    """return installed samtools version as a (major, minor) tuple.
+
+    (0, 0) is returned if the version can not be determined.
+    """
+    try:
+        out = subprocess.check_output([_SAMTOOLS, b'--version'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return (0, 0)
+
+    match = re.match(rb'samtools (\d+)\.(\d+)', out)
+    if match is None:
+        return (0, 0)
+
+    return tuple(int(x) for x in match.groups())
+
+@functools.lru_cache(maxsize=1)
+def get_max_pipe_size():
+    """return largest pipe buffer size an unprivileged process can request, or None if unknown"""
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def open_pipe():
+    """return (read_fd, write_fd) of a new pipe.
+
+    on linux the pipe buffer is enlarged to PIPE_SIZE bytes when allowed, so the writing
+    command can get further ahead before the reading command has to be scheduled.
+    """
+    read_fd, write_fd = os.pipe()
+
+    max_pipe_size = get_max_pipe_size()
+    if fcntl is not None and sys.platform.startswith('linux') and max_pipe_size is not None:
+        try:
+            fcntl.fcntl(write_fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), min(PIPE_SIZE, max_pipe_size))
+        except OSError:
+            # the per user limit on pipe buffer memory was reached, keep the default size
+            pass
+
+    return read_fd, write_fd
+
+def run_pipeline(stages):
+    """Run the given commands, piping the stdout of each command into the stdin of the next.
+
+    arguments
+
+    stages
+        - list of commands. each command is an argument list that can be passed to subprocess.
+    """
+    processes = []
+    stdin = None
+    try:
+        for i, command in enumerate(stages):
+            read_fd, stdout = open_pipe() if i < len(stages) - 1 else (None, None)
+            try:
+                # pipes are created non-inheritable and pool workers mark the fds they were handed
+                # non-inheritable in init_worker, so there are no stray fds to close in the child
+                processes.append(subprocess.Popen(command, stdin=stdin, stdout=stdout, close_fds=False))
+            finally:
+                # close our copies of the pipe ends so commands see EOF or SIGPIPE when a neighbour exits
+                if stdin is not None:
+                    os.close(stdin)
+                if stdout is not None:
+                    os.close(stdout)
+                stdin = read_fd
+
+        for p in processes:
+            p.wait()
+    finally:
+        # if a command failed to start or waiting was interrupted, don't leave the others running
+        if stdin is not None:
+            os.close(stdin)
+        for p in processes:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+    # a command that failed takes the commands writing to it down with SIGPIPE,
+    # report the command that failed rather than the first one to die
+    failed = [(p.returncode, command) for p, command in zip(processes, stages) if p.returncode != 0]
+    if failed:
+        returncode, command = next(((r, c) for r, c in failed if r != -signal.SIGPIPE), failed[0])
+        raise subprocess.CalledProcessError(returncode, command)
+
+# execute_bam arguments shared by every bam, set once per worker process by init_worker
+_worker_kwargs = {}
+
+def exit_worker(signum, frame):
+    # the worker leads a process group that every command it starts is born into, so this
+    # also kills a command that is still being spawned
+    os.killpg(os.getpgrp(), signal.SIGKILL)
+
+def make_fds_non_inheritable():
+    """mark every open fd other than stdin, stdout and stderr non-inheritable.
+
+    fds a forkserver worker receives from multiprocessing, i.e. the pool's task and result
+    queues, are inheritable and would otherwise end up in every command.
+    """
+    fd_dir = '/proc/self/fd' if os.path.isdir('/proc/self/fd') else '/dev/fd'
+    for fd in map(int, os.listdir(fd_dir)):
+        if fd > 2:
+            try:
+                os.set_inheritable(fd, False)
+            except OSError:
+                # the fd listdir read the directory with is already closed
+                pass
+
+def init_worker(pipeline_template, index_input_bam, index_threads, verbose):
+    _worker_kwargs.update(pipeline_template=pipeline_template, index_input_bam=index_input_bam,
+            index_threads=index_threads, verbose=verbose)
+    # commands are started with close_fds=False
+    make_fds_non_inheritable()
+    # the pool stops workers with SIGTERM, take their samtools commands down with them
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, exit_worker)
 
 def worker_wrapper(args):
-        return execute_bam(*args)
-        
-def execute_bam(bam_fp, output_fp, operations_dict,
-                index_input_bam=False, verbose=True):
-    """Execute a bam file"""
+    return execute_bam(*args, **_worker_kwargs)
+
+def execute_bam(bam_fp, output_fp, pipeline_template,
+                index_input_bam=False, index_threads=1, verbose=True):
+    """Execute a bam file
+
+    returns output_fp, or None if there were no operations besides indexing and so no
+    output file was written.
+    """
     # index bam if needed
     if index_input_bam:
-        index_bam(bam_fp)
+        index_bam(bam_fp, threads=index_threads)
+
+    # only indexing was requested
+    if not pipeline_template:
+        if verbose:
+            print(f'{bam_fp} indexed')
+        return None
 
     # execute remaining commands
-    command_args = generate_stream_commands(bam_fp, output_fp, operations_dict)
-    run_subprocesses(command_args)  
+    stages = render_pipeline(pipeline_template, os.fsencode(bam_fp), os.fsencode(output_fp))
+    run_pipeline(stages)
 
     if verbose:
         print(f'{bam_fp} completed')
 
     return output_fp
 
-def generate_stream_commands(bam_fp, output_fp, operations_dict):
+def generate_stream_commands(bam_fp, output_fp, operations_dict, intermediate_compression_level=0,
+                             output_format='bam', reference_fp=None):
     """
-    return command to run input bam through the given operations
+    return commands to run input bam through the given operations
 
+    each command streams its output to the next, the first command reads the input bam
+    and the last command writes the output file in output_format. streamed output is bam
+    compressed with intermediate_compression_level since it is decompressed again right away.
     """
-    command_args = []
+    stages = []
 
-    items = iter(operations_dict.items())
+    operations = tuple(operations_dict.items())
+    for i, (operation_identifier, operation_kwargs) in enumerate(operations):
+        # first operation reads the input bam, the rest read from the previous operation
+        stage_input_fp = bam_fp if i == 0 else None
+        # last operation writes an output file, the rest stream to the next operation
+        is_last = i == len(operations) - 1
+        stage_output_fp = output_fp if is_last else None
+        compression_level = None if is_last else intermediate_compression_level
+        stage_output_format = output_format if is_last else 'bam'
 
-    # get first command
-    operation_identifier, operation_kwargs = next(items)
-    # if only one operation return output
-    if len(operations_dict) == 1:
-        return get_command_from_identifier(bam_fp, output_fp, operation_identifier, operation_kwargs)
-    else:
-        command_args += get_command_from_identifier(bam_fp, None, operation_identifier, operation_kwargs) + ['|']
-
-    c = len(operations_dict) - 1
-    for operation_identifier, operation_kwargs in items:
-        # if last operation, write an output file, otherwise stream to next operation
-        if c == 1:
-            command_args += get_command_from_identifier(None, output_fp, operation_identifier, operation_kwargs)
-        else:
-            command_args += get_command_from_identifier(None, None, operation_identifier, operation_kwargs) + ['|']
-            
-        c -= 1
-    return command_args
+        stages.append(get_command_from_identifier(stage_input_fp, stage_output_fp,
+                operation_identifier, operation_kwargs, compression_level=compression_level,
+                output_format=stage_output_format, reference_fp=reference_fp))
+
+    return stages
+
+def compile_pipeline(operations_dict, intermediate_compression_level=0, output_format='bam',
+                     reference_fp=None):
+    """
+    return pipeline template to run a bam through the given operations
+
+    the template is a list of (command, input_idx, output_idx) tuples, one per command.
+    input_idx and output_idx are where the input bam and output filepaths go in the command,
+    or -1 if the command streams its input or output.
+    """
+    stages = generate_stream_commands(None, None, operations_dict,
+            intermediate_compression_level=intermediate_compression_level,
+            output_format=output_format, reference_fp=reference_fp)
+
+    pipeline_template = []
+    for i, command in enumerate(stages):
+        # filepaths are always the last arguments of a command
+        input_idx = len(command) if i == 0 else -1
+        output_idx = len(command) if i == len(stages) - 1 else -1
+        pipeline_template.append((command, input_idx, output_idx))
+
+    return pipeline_template
+
+def render_pipeline(pipeline_template, bam_fp, output_fp):
+    """return commands from pipeline template with the input and output filepaths filled in"""
+    stages = []
+    for command, input_idx, output_idx in pipeline_template:
+        command = list(command)
+        # input goes in first since it never comes before the output
+        if input_idx >= 0:
+            command.insert(input_idx, bam_fp)
+        if output_idx >= 0:
+            command[output_idx:output_idx] = [b'-o', output_fp]
+        stages.append(command)
 
-def get_command_from_identifier(bam_fp, output_fp, identifier, kwargs):
+    return stages
+
+def get_command_from_identifier(bam_fp, output_fp, identifier, kwargs, compression_level=None,
+                                output_format='bam', reference_fp=None):
     """return command given identifier and operation kwargs"""
+    output_kwargs = {'compression_level': compression_level, 'output_format': output_format,
+            'reference_fp': reference_fp}
+
     if identifier == 'sort':
-        return get_sort_command(bam_fp, output_fp, sort_threads=kwargs['sort_threads'])
+        return get_sort_command(bam_fp, output_fp, sort_threads=kwargs['sort_threads'],
+                sort_memory=kwargs.get('sort_memory', '768M'),
+                sort_block_size=kwargs.get('sort_block_size'), **output_kwargs)
     if identifier == 'position_filter':
-        return get_position_filter_command(bam_fp, output_fp, kwargs['positions_fp'])
+        return get_position_filter_command(bam_fp, output_fp, kwargs['positions_fp'],
+                multi_region=kwargs.get('multi_region', False), **output_kwargs)
 
     raise ValueError(f'identifier was {identifier}. Must be sort or position_filter')
 
-def get_sort_command(bam_fp, output_fp, sort_threads=1):
+def get_output_format_args(output_format, reference_fp=None):
+    """return samtools arguments to write output_format, "bam" or "cram".
+
+    reference_fp is the reference fasta cram output is encoded against.
+    """
+    if output_format not in ('bam', 'cram'):
+        raise ValueError(f'output_format was {output_format}. Must be bam or cram')
+
+    args = [b'--output-fmt', output_format.encode()]
+    if reference_fp is not None:
+        args += [b'--reference', os.fsencode(reference_fp)]
+
+    return args
+
+def get_sort_command(bam_fp, output_fp, sort_threads=1, sort_memory='768M', sort_block_size=None,
+                     compression_level=None, output_format='bam', reference_fp=None):
     """get samtools sort command
 
     arguments
@@ -109,18 +284,41 @@ def get_sort_command(bam_fp, output_fp, sort_threads=1):
         - input bam filepath. set to None if input is to be streamed.
     output_fp
         - filepath for sorted output bam. set to None to stream output to std out.
+    sort_threads
+        - number of threads samtools uses for sorting and compression.
+    sort_memory
+        - maximum memory per sort thread, i.e. 768M or 2G.
+    sort_block_size
+        - size in bytes of the blocks the input is read in. set to None to use the samtools default.
+    compression_level
+        - bam compression level from 0 to 9. set to None to use the samtools default.
+    output_format
+        - "bam" or "cram"
+    reference_fp
+        - reference fasta filepath for cram output.
     """
-    samtools_command = ['samtools', 'sort']
+    samtools_command = [_SAMTOOLS, b'sort', b'-@', str(sort_threads).encode(),
+            b'-m', os.fsencode(sort_memory)]
+
+    if sort_block_size is not None:
+        samtools_command += [b'--input-fmt-option', f'block_size={sort_block_size}'.encode()]
+
+    if compression_level is not None:
+        samtools_command += [b'-l', str(compression_level).encode()]
+
+    if output_format != 'bam':
+        samtools_command += get_output_format_args(output_format, reference_fp)
 
     if output_fp is not None:
-        samtools_command += ['-o', output_fp]
+        samtools_command += [b'-o', os.fsencode(output_fp)]
 
     if bam_fp is not None:
-        samtools_command.append(bam_fp)
+        samtools_command.append(os.fsencode(bam_fp))
 
     return samtools_command
 
-def get_position_filter_command(bam_fp, output_fp, positions_fp):
+def get_position_filter_command(bam_fp, output_fp, positions_fp, multi_region=False,
+                                compression_level=None, output_format='bam', reference_fp=None):
     """get samtools position filter command
 
     arguments
@@ -132,29 +330,91 @@ def get_position_filter_command(bam_fp, output_fp, positions_fp):
     positions_fp
         - filepath for positions .bed file. File contains tab seperated positions in the following format:
         <chrom>\t<start-pos>\t<stop-pos>
+    multi_region
+        - use the multi-region iterator to jump to the positions with the bam index instead
+        of reading every alignment. input bam must be indexed.
+    compression_level
+        - bam compression level from 0 to 9, 0 is uncompressed. set to None to use the
+        samtools default.
+    output_format
+        - "bam" or "cram". compression_level is ignored for cram.
+    reference_fp
+        - reference fasta filepath for cram output.
     """
-    samtools_command = ['samtools', 'view', '-h', '-L', positions_fp]
+    samtools_command = [_SAMTOOLS, b'view', b'-h', b'-L', os.fsencode(positions_fp)]
+
+    if multi_region:
+        samtools_command.append(b'-M')
+
+    if output_format != 'bam':
+        samtools_command += get_output_format_args(output_format, reference_fp)
+    elif compression_level is None:
+        samtools_command.append(b'-b')
+    elif compression_level == 0:
+        # uncompressed bam
+        samtools_command.append(b'-u')
+    else:
+        samtools_command += [b'-b', b'-l', str(compression_level).encode()]
 
     if output_fp is not None:
-        samtools_command += ['-o', output_fp]
+        samtools_command += [b'-o', os.fsencode(output_fp)]
 
     if bam_fp is not None:
-        samtools_command.append(bam_fp)
+        samtools_command.append(os.fsencode(bam_fp))
 
     return samtools_command
 
-def index_bam(bam_fp):
+@contextlib.contextmanager
+def shared_positions_file(positions_fp):
+    """copy positions file into memory and yield a filepath any process can read the copy from.
+
+    samtools processes reading the yielded filepath all share the same in memory pages. the
+    filepath only exists until the context exits. positions_fp is yielded unchanged if it is
+    None or in memory files aren't supported.
+    """
+    if positions_fp is None or not hasattr(os, 'memfd_create') or not os.path.isdir('/proc/self/fd'):
+        yield positions_fp
+        return
+
+    fd = os.memfd_create('samwrap-positions')
+    try:
+        with open(positions_fp, 'rb') as f:
+            data = memoryview(f.read())
+        while data:
+            data = data[os.write(fd, data):]
+
+        yield f'/proc/{os.getpid()}/fd/{fd}'
+    finally:
+        os.close(fd)
+
+def get_output_fp(bam_fp, output_dir, output_descriptor, output_format='bam'):
+    """return output filepath for the given input bam.
+
+    the trailing .bam of the input filename is replaced with <output_descriptor>.<output_format>
+    """
+    sample = _BAM_SUFFIX_RE.sub(f'{output_descriptor}.{output_format}', os.path.basename(bam_fp))
+    return os.path.join(output_dir, sample)
+
+def index_bam(bam_fp, threads=1):
     """Index the given bam file.
 
-    The indexed .bai file will be put in same directory as input file
+    The indexed .bai file will be put in same directory as input file.
+    Indexing is done in process with pysam if it is installed.
     """
-    samtools_command = ['samtools', 'index', bam_fp]
-    subprocess.check_output(samtools_command)
+    thread_args = ['-@', str(threads)] if threads > 1 else []
+
+    if pysam is not None:
+        pysam.index(*thread_args, bam_fp)
+        return
+
+    samtools_command = [_SAMTOOLS, b'index'] + [os.fsencode(a) for a in thread_args] + [os.fsencode(bam_fp)]
+    subprocess.check_output(samtools_command, close_fds=False)
 
     
 class SamtoolsWrapper(object):
     def __init__(self, input_files, output_dir, operations_dict,
-                 output_descriptor='.samwrap', threads=1, verbose=True):
+                 output_descriptor='.samwrap', threads=1, intermediate_compression_level=0,
+                 output_format='bam', reference_fp=None, verbose=True):
         """Wrapper for Samtools
         
         args:
@@ -163,9 +423,9 @@ class SamtoolsWrapper(object):
             list of input bams
         output_dir: str
             directory to store outputs in
-        operations_dict: OrderedDict
+        operations_dict: dict
             dict storing the samtools operations to perform on the input files.
-            operations will be preformed in the same order as in the ordered dict.
+            operations will be preformed in the same order as in the dict.
             
             {<operation_identifier>: <operation_kwargs>}
             
@@ -173,17 +433,29 @@ class SamtoolsWrapper(object):
             
             operation_kwargs - arguments for the operation.
                 for position filter - {'positions_fp': '/path/to/positions.bed'}
-                for sort - {'sort_threads': num_sort_threads}
-                for index - None
+                for sort - {'sort_threads': num_sort_threads, 'sort_memory': '768M',
+                            'sort_block_size': 1000000}
+                for index - {'index_threads': num_index_threads} or None
             
         kwargs:
         
         threads: int
             number of precesses to use
+        intermediate_compression_level: int
+            compression level from 0 to 9 for bams streamed between operations
+        output_format: str
+            format of the output files, "bam" or "cram"
+        reference_fp: str
+            reference fasta to encode cram output against. required for cram output
         verbose: bool
             verbose output
             
         """
+        if output_format not in ('bam', 'cram'):
+            raise ValueError(f'output_format was {output_format}. Must be bam or cram')
+        if output_format == 'cram' and reference_fp is None:
+            raise ValueError('reference_fp must be given for cram output')
+
         self.input_files = input_files
         self.output_dir = output_dir
         
@@ -192,24 +464,66 @@ class SamtoolsWrapper(object):
         self.output_descriptor = output_descriptor
         self.num_threads = threads
         self.verbose = verbose
-        
+
+        # probe samtools once here so workers never have to
+        self.samtools_version = get_samtools_version()
+
+        # pull out index if it's in operations, it's run on the input bams before the rest
+        operations_dict = dict(operations_dict)
+        self.index_input_bam = 'index' in operations_dict
+        self.index_threads = (operations_dict.pop('index', None) or {}).get('index_threads', 1)
+
+        # indexed inputs can be filtered by jumping to the positions instead of reading every alignment.
+        # only a filter that is the first operation reads the indexed input, later ones read a stream
+        if (self.index_input_bam and self.samtools_version >= MULTI_REGION_VERSION
+                and next(iter(operations_dict), None) == 'position_filter'):
+            operations_dict['position_filter'] = {**operations_dict['position_filter'],
+                    'multi_region': True}
+
+        # don't run more sort threads than there are cpus
+        sort_threads = 1
+        for identifier, kwargs in operations_dict.items():
+            if identifier == 'sort':
+                sort_threads = max(sort_threads, kwargs['sort_threads'])
+        self.num_processes = max(1, min(self.num_threads, (os.cpu_count() or 1) // sort_threads))
+
+        # commands are built once here, workers only fill in the input and output filepaths
+        self.pipeline_operations = operations_dict
+        self.intermediate_compression_level = intermediate_compression_level
+        self.output_format = output_format
+        self.reference_fp = reference_fp
+        self.pipeline_template = self.get_pipeline_template(operations_dict)
+
+    def get_pipeline_template(self, operations_dict):
+        """return pipeline template for the given operations with this wrapper's output settings"""
+        return compile_pipeline(operations_dict,
+                intermediate_compression_level=self.intermediate_compression_level,
+                output_format=self.output_format, reference_fp=self.reference_fp)
+
     def run_bams(self):
-        # pull out index if it's in operations
-        if 'index' in self.operations_dict:
-            index_input_bam = True
-            del self.operations_dict['index']
-        else:
-            index_input_bam = False
-                    
-        # create argument pool
-        arg_pool = []
-        for fp in self.input_files:
-            sample = fp.split('/')[-1]
-            sample = re.sub(r'.bam', self.output_descriptor + '.bam', sample)
-            output_fp = os.path.join(self.output_dir, sample)
-            arg_pool.append((fp, output_fp, self.operations_dict, index_input_bam, self.verbose))
-        
-        with Pool(self.num_threads) as p:
-            results = p.map(worker_wrapper, arg_pool)
+        # every bam is filtered with the same positions, open them once and share them with all workers
+        positions_fp = self.pipeline_operations.get('position_filter', {}).get('positions_fp')
+
+        with shared_positions_file(positions_fp) as shared_positions_fp:
+            pipeline_template = self.pipeline_template
+            if shared_positions_fp != positions_fp:
+                operations_dict = dict(self.pipeline_operations)
+                operations_dict['position_filter'] = {**operations_dict['position_filter'],
+                        'positions_fp': shared_positions_fp}
+                pipeline_template = self.get_pipeline_template(operations_dict)
+
+            # create argument pool, arguments shared by every bam are sent once per worker
+            arg_pool = [(fp, get_output_fp(fp, self.output_dir, self.output_descriptor, self.output_format))
+                    for fp in self.input_files]
+            initargs = (pipeline_template, self.index_input_bam, self.index_threads, self.verbose)
+
+            # forkserver workers don't inherit a copy of this process, results are handled as they finish.
+            # leaving the pool terminates it, so a failed bam stops the running ones and their commands
+            results = []
+            with get_context('forkserver').Pool(self.num_processes, initializer=init_worker,
+                    initargs=initargs) as p:
+                for output_fp in p.imap_unordered(worker_wrapper, arg_pool, chunksize=1):
+                    if output_fp is not None:
+                        results.append(output_fp)
 
         print(results)
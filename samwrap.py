@@ -2,7 +2,6 @@
 
 import argparse
 import os
-from collections import OrderedDict
 
 from samtools_wrapper import SamtoolsWrapper
 
@@ -25,14 +24,25 @@ options:
 
 --bulk-index: bool bulk index the input bams
 
+--index-threads: int number of threads to use for indexing. Default is 1.
+
 --bulk-sort: bool bulk sort the input bams
 
 --sort-threads: int number of threads samtools should use for sorting. Default is 1.
 
+--sort-memory: str maximum memory per sort thread, i.e. 768M or 2G. Default is 768M.
+
+--sort-block-size: int size in bytes of the blocks samtools sort reads its input in.
+    Default is 1000000. Raise to i.e. 10000000 when memory permits.
+
 --filter-positions: .bed file positions to keep in bams three columns.
     Format is <chrom>\t<start-pos>\t<end-pos>.
     Positions are inclusive.
 
+--output-format: str format of output files, bam or cram. Default is bam.
+
+--reference: .fa file reference fasta to encode cram output against. Required for cram output.
+
 --output-descriptor: identifier to put in output files.
     for example a value of ".filtered.sorted" would produce files in output directory 
     like input_name.filtered.sorted.bam
@@ -55,13 +65,23 @@ parser.add_argument('--output-dir', type=str,
 
 parser.add_argument('--bulk-index',
         action="store_true", help='Index the input bams')
+parser.add_argument('--index-threads', type=int,
+        default=1, help='Number of threads to use during indexing. Default is 1.')
 parser.add_argument('--bulk-sort',
         action='store_true', help='Sort output bams')
 parser.add_argument('--sort-threads', type=int,
         default=1, help='Number of threads for samtools to use during sorting.')
+parser.add_argument('--sort-memory', type=str,
+        default='768M', help='Maximum memory per sort thread. Default is 768M.')
+parser.add_argument('--sort-block-size', type=int,
+        default=1000000, help='Size in bytes of the blocks samtools sort reads its input in. Default is 1000000.')
 parser.add_argument('--filter-positions', type=str,
         help='''.bed file containing positions to filter bams with.\n
             Format is the following: <chrom>\t<start-pos>\t<end-pos>''')
+parser.add_argument('--output-format', type=str,
+        default='bam', choices=['bam', 'cram'], help='Format of output files. Default is bam.')
+parser.add_argument('--reference', type=str,
+        help='Reference fasta to encode cram output against. Required for cram output.')
 parser.add_argument('--output-descriptor', type=str,
         default='.output', help='''identifier to put in output files.\n
             for example a value of ".filtered.sorted" would produce files in output directory\n
@@ -71,27 +91,28 @@ parser.add_argument('--threads', type=int,
 parser.add_argument('--verbose', action='store_true',
         help='Print names of files to std error as they are processed. Default is True')
 
-args = parser.parse_args()
-
 def get_fps_from_file(fp):
-    f = open(fp)
-    return [line.replace('\n', '') for line in f]
+    with open(fp) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
 
 def get_fps_from_dir(dir_path):
-    return [os.path.join(dir_path, p) for p in os.listdir(dir_path)
-          if p[-4:] == '.bam']
+    with os.scandir(dir_path) as entries:
+        return [entry.path for entry in entries
+              if entry.is_file() and entry.name.endswith('.bam')]
 
-def get_input_files():
+def get_input_files(args):
     if args.input_dir is not None:
         return get_fps_from_dir(args.input_dir)
     else:
         return get_fps_from_file(args.input_files)
 
-def get_operations_dict():
-    d = OrderedDict()
+def get_operations_dict(args):
+    d = {}
 
     if args.bulk_index:
-        d['index'] = None
+        d['index'] = {
+                'index_threads': args.index_threads
+                }
 
     if args.filter_positions is not None:
         d['position_filter'] = {
@@ -100,27 +121,35 @@ def get_operations_dict():
 
     if args.bulk_sort:
         d['sort'] = {
-                'sort_threads': args.sort_threads
+                'sort_threads': args.sort_threads,
+                'sort_memory': args.sort_memory,
+                'sort_block_size': args.sort_block_size
                 }
 
     return d
 
-def check_arguments():
+def check_arguments(args):
     if args.output_dir is None:
         raise ValueError('Must specify --output-dir')
 
     if args.input_dir is None and args.input_files is None:
         raise ValueError('Must specify an --input-files file list or --input_dir directory.')
 
+    if args.output_format == 'cram' and args.reference is None:
+        raise ValueError('Must specify --reference for --output-format cram.')
+
 def main():
-    check_arguments()
+    args = parser.parse_args()
+
+    check_arguments(args)
 
-    input_fps = get_input_files()
+    input_fps = get_input_files(args)
 
-    operations_dict = get_operations_dict()
+    operations_dict = get_operations_dict(args)
 
     sw = SamtoolsWrapper(input_fps, args.output_dir, operations_dict,
-        output_descriptor=args.output_descriptor, threads=args.threads, verbose=args.verbose)
+        output_descriptor=args.output_descriptor, threads=args.threads,
+        output_format=args.output_format, reference_fp=args.reference, verbose=args.verbose)
     sw.run_bams()
 
 if __name__ == '__main__':
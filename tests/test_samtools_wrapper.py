@@ -0,0 +1,286 @@
+import os
+import subprocess
+import sys
+import time
+import types
+
+import pytest
+
+import samtools_wrapper
+from samtools_wrapper import (SamtoolsWrapper, compile_pipeline, get_output_fp, open_pipe,
+                              render_pipeline, run_pipeline, shared_positions_file)
+
+ST = samtools_wrapper._SAMTOOLS
+
+SORT = {'sort_threads': 2, 'sort_memory': '1G'}
+FILTER = {'positions_fp': 'positions.bed'}
+
+
+def test_single_stage_template():
+    template = compile_pipeline({'sort': SORT})
+
+    assert template == [([ST, b'sort', b'-@', b'2', b'-m', b'1G'], 6, 6)]
+    assert render_pipeline(template, b'in.bam', b'out.bam') == [
+            [ST, b'sort', b'-@', b'2', b'-m', b'1G', b'-o', b'out.bam', b'in.bam']]
+
+
+def test_multi_stage_template():
+    template = compile_pipeline({'position_filter': FILTER, 'sort': SORT})
+
+    assert [(input_idx, output_idx) for _, input_idx, output_idx in template] == [(6, -1), (-1, 6)]
+    assert render_pipeline(template, b'in.bam', b'out.bam') == [
+            [ST, b'view', b'-h', b'-L', b'positions.bed', b'-u', b'in.bam'],
+            [ST, b'sort', b'-@', b'2', b'-m', b'1G', b'-o', b'out.bam']]
+
+
+def test_render_does_not_modify_template():
+    template = compile_pipeline({'sort': SORT})
+    command = list(template[0][0])
+
+    render_pipeline(template, b'in.bam', b'out.bam')
+
+    assert template[0][0] == command
+
+
+def test_final_filter_writes_bam():
+    stages = render_pipeline(compile_pipeline({'position_filter': FILTER}), b'in.bam', b'out.bam')
+
+    assert stages == [[ST, b'view', b'-h', b'-L', b'positions.bed', b'-b', b'-o', b'out.bam', b'in.bam']]
+
+
+def test_intermediate_compression_level():
+    template = compile_pipeline({'position_filter': FILTER, 'sort': SORT},
+            intermediate_compression_level=1)
+
+    assert template[0][0][-3:] == [b'-b', b'-l', b'1']
+    assert b'-l' not in template[1][0]
+
+
+def test_cram_only_on_final_stage():
+    template = compile_pipeline({'sort': SORT, 'position_filter': FILTER},
+            output_format='cram', reference_fp='ref.fa')
+
+    assert b'cram' not in template[0][0]
+    assert template[1][0][-4:] == [b'--output-fmt', b'cram', b'--reference', b'ref.fa']
+
+
+def test_unknown_identifier():
+    with pytest.raises(ValueError):
+        compile_pipeline({'merge': {}})
+
+
+# fcntl commands missing from python < 3.10
+F_SETPIPE_SZ, F_GETPIPE_SZ = 1031, 1032
+
+
+def read_pipe_size(fd):
+    fcntl = pytest.importorskip('fcntl')
+    return fcntl.fcntl(fd, getattr(fcntl, 'F_GETPIPE_SZ', F_GETPIPE_SZ))
+
+
+def check_pipe(read_fd, write_fd):
+    try:
+        assert not os.get_inheritable(read_fd) and not os.get_inheritable(write_fd)
+        os.write(write_fd, b'abc')
+        assert os.read(read_fd, 3) == b'abc'
+        return read_pipe_size(write_fd)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='pipe sizes are only set on linux')
+def test_open_pipe():
+    expected = min(samtools_wrapper.PIPE_SIZE, samtools_wrapper.get_max_pipe_size())
+
+    assert check_pipe(*open_pipe()) == expected
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='pipe sizes are only set on linux')
+def test_open_pipe_keeps_default_size(monkeypatch):
+    default_size = check_pipe(*os.pipe())
+
+    def refuse(fd, cmd, arg=0):
+        raise PermissionError('pipe buffer limit reached')
+
+    # a full per user pipe buffer budget keeps the default size
+    monkeypatch.setattr(samtools_wrapper, 'fcntl', types.SimpleNamespace(fcntl=refuse))
+
+    assert check_pipe(*open_pipe()) == default_size
+
+
+def test_run_pipeline(tmp_path):
+    output_fp = tmp_path / 'out.txt'
+
+    run_pipeline([['printf', 'abc'], ['tr', 'a-c', 'A-C'], ['sh', '-c', 'cat > "$0"', str(output_fp)]])
+
+    assert output_fp.read_text() == 'ABC'
+
+
+def test_run_pipeline_reports_failed_stage_not_sigpipe():
+    # yes is killed by SIGPIPE once the stage reading from it fails
+    stages = [['yes'], ['sh', '-c', 'head -c 1 > /dev/null; exit 3']]
+
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        run_pipeline(stages)
+
+    assert excinfo.value.returncode == 3
+    assert excinfo.value.cmd == stages[1]
+
+
+def test_run_pipeline_reports_first_failed_stage():
+    stages = [['sh', '-c', 'exit 2'], ['sh', '-c', 'cat > /dev/null; exit 4']]
+
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        run_pipeline(stages)
+
+    assert excinfo.value.returncode == 2
+    assert excinfo.value.cmd == stages[0]
+
+
+def test_run_pipeline_kills_started_stages(monkeypatch, tmp_path):
+    started = []
+
+    class Popen(subprocess.Popen):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            started.append(self)
+
+    monkeypatch.setattr(subprocess, 'Popen', Popen)
+
+    with pytest.raises(OSError):
+        run_pipeline([['sleep', '10'], [str(tmp_path / 'missing')]])
+
+    assert len(started) == 1
+    assert started[0].returncode is not None
+
+
+@pytest.mark.parametrize('bam_fp, expected', [
+    ('/data/sample.bam', '/out/sample.filtered.bam'),
+    ('/data/sample-1bam-chr.bam', '/out/sample-1bam-chr.filtered.bam'),
+    ('/data/sample.bam.bam', '/out/sample.bam.filtered.bam'),
+])
+def test_output_fp(bam_fp, expected):
+    assert get_output_fp(bam_fp, '/out', '.filtered') == expected
+
+
+def test_output_fp_cram():
+    assert get_output_fp('/data/sample.bam', '/out', '.filtered', 'cram') == '/out/sample.filtered.cram'
+
+
+def test_shared_positions_file_without_positions():
+    with shared_positions_file(None) as positions_fp:
+        assert positions_fp is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'memfd_create') or not os.path.isdir('/proc/self/fd'),
+                    reason='needs memfd_create and /proc')
+def test_shared_positions_file(tmp_path):
+    bed = tmp_path / 'positions.bed'
+    bed.write_text('chr1\t100\t200\nchr2\t300\t400\n')
+
+    with shared_positions_file(str(bed)) as positions_fp:
+        assert positions_fp != str(bed)
+        # samtools reads the copy from other processes
+        assert subprocess.check_output(['cat', positions_fp]) == bed.read_bytes()
+        bed.unlink()
+        assert subprocess.check_output(['cat', positions_fp]) == b'chr1\t100\t200\nchr2\t300\t400\n'
+
+    assert not os.path.exists(positions_fp)
+
+
+@pytest.fixture
+def samtools_1_10(monkeypatch):
+    monkeypatch.setattr(samtools_wrapper, 'get_samtools_version', lambda: (1, 10))
+
+
+def test_index_only_pipeline_is_empty(samtools_1_10):
+    sw = SamtoolsWrapper([], '/out', {'index': None})
+
+    assert sw.index_input_bam
+    assert sw.pipeline_template == []
+
+
+def test_operations_dict_not_modified(samtools_1_10):
+    operations_dict = {'index': {'index_threads': 2}, 'sort': SORT}
+
+    sw = SamtoolsWrapper([], '/out', operations_dict)
+
+    assert operations_dict == {'index': {'index_threads': 2}, 'sort': SORT}
+    assert sw.index_threads == 2
+
+
+def test_multi_region_when_filter_reads_indexed_input(samtools_1_10):
+    sw = SamtoolsWrapper([], '/out', {'index': None, 'position_filter': FILTER, 'sort': SORT})
+
+    assert b'-M' in sw.pipeline_template[0][0]
+
+
+def test_no_multi_region_when_filter_reads_stream(samtools_1_10):
+    sw = SamtoolsWrapper([], '/out', {'index': None, 'sort': SORT, 'position_filter': FILTER})
+
+    assert all(b'-M' not in command for command, _, _ in sw.pipeline_template)
+
+
+def test_no_multi_region_without_index(samtools_1_10):
+    sw = SamtoolsWrapper([], '/out', {'position_filter': FILTER})
+
+    assert b'-M' not in sw.pipeline_template[0][0]
+
+
+def test_cram_requires_reference(samtools_1_10):
+    with pytest.raises(ValueError):
+        SamtoolsWrapper([], '/out', {'sort': SORT}, output_format='cram')
+
+
+# stands in for samtools, logs when it starts and finishes a bam. called as
+# stub <log> -o <output> <bam>
+STUB_SAMTOOLS = """\
+for bam; do :; done
+echo "start $bam" >> "$1"
+case "$bam" in
+    *fail*) exit 1 ;;
+    *slow*) sleep 1 ;;
+esac
+echo "done $bam" >> "$1"
+"""
+
+
+def test_run_bams_stops_at_first_failure(samtools_1_10, tmp_path):
+    stub = tmp_path / 'samtools'
+    stub.write_text(STUB_SAMTOOLS)
+    log = tmp_path / 'log'
+    bams = [str(tmp_path / f'{name}.bam') for name in ('slow1', 'fail', 'slow2', 'c', 'd')]
+
+    sw = SamtoolsWrapper(bams, str(tmp_path / 'out'), {}, verbose=False)
+    sw.pipeline_template = [([b'/bin/sh', os.fsencode(stub), os.fsencode(log)], 3, 3)]
+    # one process per cpu would run the bams one after another
+    sw.num_processes = 2
+
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        sw.run_bams()
+    assert time.monotonic() - start < 1
+
+    ran = log.read_text()
+    # long enough for a slow bam that is still running to finish
+    time.sleep(1.5)
+
+    assert log.read_text() == ran
+    assert 'done' not in ran
+    assert 'c.bam' not in ran and 'd.bam' not in ran
+
+
+def test_commands_only_get_their_own_fds(samtools_1_10, tmp_path):
+    bam = tmp_path / 'sample.bam'
+    bam.touch()
+    output_fp = tmp_path / 'sample.fds.bam'
+
+    sw = SamtoolsWrapper([str(bam)], str(tmp_path), {}, output_descriptor='.fds', verbose=False)
+    # ls lists the fds it was started with, plus the one it reads the directory with
+    sw.pipeline_template = [([b'/bin/ls', b'/proc/self/fd'], 2, -1),
+                            ([b'/bin/sh', b'-c', b'cat > "$2"', b'sh'], -1, 4)]
+    sw.run_bams()
+
+    fds = output_fp.read_text().split('/proc/self/fd:\n')[1].split()
+    assert fds == ['0', '1', '2', '3']
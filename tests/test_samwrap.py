@@ -0,0 +1,16 @@
+from samwrap import get_fps_from_dir, get_fps_from_file
+
+
+def test_fps_from_file(tmp_path):
+    input_files = tmp_path / 'input_files.txt'
+    input_files.write_text('/data/a.bam\n\n/data/b.bam\n   \n/data/c.bam')
+
+    assert get_fps_from_file(str(input_files)) == ['/data/a.bam', '/data/b.bam', '/data/c.bam']
+
+
+def test_fps_from_dir(tmp_path):
+    for name in ('a.bam', 'b.bam', 'a.bam.bai', 'notes.txt'):
+        (tmp_path / name).touch()
+    (tmp_path / 'dir.bam').mkdir()
+
+    assert sorted(get_fps_from_dir(str(tmp_path))) == [str(tmp_path / 'a.bam'), str(tmp_path / 'b.bam')]